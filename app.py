@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, redirect, render_template, session, url_for, send_from_directory, flash
+from flask import Flask, request, jsonify, redirect, render_template, session, url_for, send_from_directory, flash, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_cors import CORS
@@ -8,8 +8,9 @@ from os import environ as env
 from datetime import datetime
 import uuid
 import re
-from sqlalchemy import func
-from database import Patient, Provider
+import threading
+from sqlalchemy import func, insert
+from database import Patient, Provider, cache
 from bokeh.resources import INLINE
 from urllib.parse import quote_plus, urlencode
 from datetime import datetime
@@ -19,6 +20,10 @@ ENV_FILE = find_dotenv('.env')
 if ENV_FILE:
     load_dotenv(ENV_FILE)
 
+# Bokeh resources are static, so render them once
+JS_RESOURCES = INLINE.render_js()
+CSS_RESOURCES = INLINE.render_css()
+
 # Initialize Flask app
 app = Flask(__name__, static_url_path='/assets', static_folder='assets', template_folder='')
 
@@ -26,18 +31,53 @@ app = Flask(__name__, static_url_path='/assets', static_folder='assets', templat
 app.secret_key = env.get("APP_SECRET_KEY")
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///endo.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['BCRYPT_LOG_ROUNDS'] = 10
 
 # Initialize SQLAlchemy and other extensions
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 CORS(app)
 
+# Redis cache for Mongo lookups, disabled when no REDIS_URL is configured
+if env.get('REDIS_URL'):
+    cache.init_app(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': env.get('REDIS_URL')})
+else:
+    cache.init_app(app, config={'CACHE_TYPE': 'NullCache'})
+
 # OAuth configuration
 oauth = OAuth(app)
 oauth.register("auth0", client_id=env.get("AUTH0_CLIENT_ID"), client_secret=env.get("AUTH0_CLIENT_SECRET"),
-               client_kwargs={"scope": "openid profile email"},
+               client_kwargs={"scope": "openid profile email", "default_timeout": 10},
                server_metadata_url=f'https://{env.get("AUTH0_DOMAIN")}/.well-known/openid-configuration')
 
+
+def prime_auth0_keys():
+    # Fetches the OIDC discovery document and JWKS so the first login doesn't have to.
+    # Authlib re-fetches the JWKS itself when it sees an unknown key ID, so no refresh loop is needed.
+    try:
+        oauth.auth0.fetch_jwk_set()
+    except Exception as e:
+        print(f'Failed to load Auth0 keys: {str(e)}')
+
+
+# Primed once per process on its first request, so it also runs in every WSGI worker after a fork
+auth0_primed = False
+auth0_prime_lock = threading.Lock()
+
+
+@app.before_request
+def prime_auth0_keys_once():
+    global auth0_primed
+    if auth0_primed:
+        return
+    with auth0_prime_lock:
+        if auth0_primed:
+            return
+        auth0_primed = True
+    # In the background, so the first request doesn't wait on Auth0
+    threading.Thread(target=prime_auth0_keys, daemon=True).start()
+
+
 # Models
 class User(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -67,13 +107,41 @@ class Survey(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 # Helper functions
+MAX_SURVEY_BATCH = 100
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
 def validate_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    if '@' not in email or len(email) > 254:
+        return False
+    return EMAIL_PATTERN.match(email) is not None
 
 def validate_password(password):
     return len(password) >= 8
 
+def build_survey_row(data):
+    # Parse created_at from ISO 8601, raises ValueError on a malformed date
+    created_at = data.get('createdAt')
+    if created_at:
+        created_at = datetime.fromisoformat(created_at)
+    else:
+        created_at = datetime.utcnow()  # Default to now if not provided
+
+    return {
+        'id': str(uuid.uuid4()),
+        'user_id': data.get('user_id'),
+        'is_on_period': data.get('isOnPeriod', False),
+        'period_flow': data.get('periodFlow', 0),
+        'change_frequency': data.get('changeFrequency', 0),
+        'has_spotting': data.get('hasSpotting', False),
+        'has_pain': data.get('hasPain', False),
+        'pain_level': data.get('painLevel', 0),
+        'sleep_quality': data.get('sleepQuality', 0),
+        'pain_qualities': ','.join(data.get('painQualities', [])),
+        'pain_timing': data.get('painTiming', ''),
+        'pain_spread': data.get('painSpread', ''),
+        'created_at': created_at
+    }
+
 # API Routes
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -174,55 +242,66 @@ def submit_survey():
     if not user_id:
         return jsonify({'error': 'User ID is required'}), 400
 
-    # Parse created_at from ISO 8601
-    created_at = data.get('createdAt')
-    if created_at:
+    try:
+        row = build_survey_row(data)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid ISO 8601 date format', 'details': str(e)}), 400
+
+    try:
+        # Core insert skips the ORM identity map for a single row
+        db.session.execute(insert(Survey), [row])
+        db.session.commit()
+        return jsonify({'message': 'Survey submitted successfully', 'survey_id': row['id']}), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Failed to submit survey: {str(e)}'}), 500
+
+
+@app.route('/api/surveys/batch', methods=['POST'])
+def submit_surveys_batch():
+    data = request.get_json()
+
+    if not isinstance(data, list) or not data:
+        return jsonify({'error': 'A non-empty list of surveys is required'}), 400
+
+    if len(data) > MAX_SURVEY_BATCH:
+        return jsonify({'error': f'At most {MAX_SURVEY_BATCH} surveys can be submitted at once'}), 413
+
+    new_surveys = list()
+    for survey in data:
+        if not isinstance(survey, dict) or not survey.get('user_id'):
+            return jsonify({'error': 'User ID is required'}), 400
+
         try:
-            created_at = datetime.fromisoformat(created_at)  # Parse ISO 8601
+            new_surveys.append(Survey(**build_survey_row(survey)))
         except ValueError as e:
             return jsonify({'error': 'Invalid ISO 8601 date format', 'details': str(e)}), 400
-    else:
-        print("No created_at")
-        created_at = datetime.utcnow()  # Default to now if not provided
-
-    # Create the new survey object
-    new_survey = Survey(
-        id=str(uuid.uuid4()),
-        user_id=user_id,
-        is_on_period=data.get('isOnPeriod', False),
-        period_flow=data.get('periodFlow', 0),
-        change_frequency=data.get('changeFrequency', 0),
-        has_spotting=data.get('hasSpotting', False),
-        has_pain=data.get('hasPain', False),
-        pain_level=data.get('painLevel', 0),
-        sleep_quality=data.get('sleepQuality', 0),
-        pain_qualities=','.join(data.get('painQualities', [])),
-        pain_timing=data.get('painTiming', ''),
-        pain_spread=data.get('painSpread', ''),
-        created_at=created_at
-    )
 
     try:
-        db.session.add(new_survey)
+        # One transaction for the whole batch
+        db.session.bulk_save_objects(new_surveys)
         db.session.commit()
-        return jsonify({'message': 'Survey submitted successfully', 'survey_id': new_survey.id}), 201
+        return jsonify({'message': 'Surveys submitted successfully',
+                        'survey_ids': [survey.id for survey in new_surveys]}), 201
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': f'Failed to submit survey: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to submit surveys: {str(e)}'}), 500
 
-oauth = OAuth(app)
-oauth.register("auth0", client_id=env.get("AUTH0_CLIENT_ID"), client_secret=env.get("AUTH0_CLIENT_SECRET"),
-               client_kwargs={"scope": "openid profile email"},
-               server_metadata_url=f'https://{env.get("AUTH0_DOMAIN")}/.well-known/openid-configuration')
+
+def get_userinfo():
+    # Resolved lazily, once per request, and only by routes that need the user
+    if 'userinfo' not in g:
+        g.userinfo = (session.get('user') or {}).get('userinfo') or {}
+    return g.userinfo
 
 
-def extract_user_id(s):
-    return s['user']['userinfo']['sub'][6:]
+def extract_user_id():
+    sub = get_userinfo().get('sub')
+    return sub[6:] if sub else None
 
 
-def extract_user_name(s):
-    user_name = s['user']['userinfo']['nickname']
-    return user_name
+def extract_user_name():
+    return get_userinfo().get('nickname')
 
 
 @app.route('/')
@@ -233,8 +312,8 @@ def index():
 @app.route('/patients')
 def patients():
     if session.get('user'):  # Indicates logged in
-        user_name = extract_user_name(session)
-        user_id = extract_user_id(session)
+        user_name = extract_user_name()
+        user_id = extract_user_id()
         provider = Provider(user_id=user_id)
         records = provider.patients_overview(encrypted=False)
         return render_template('patients.html', user_name=user_name, records=records)
@@ -245,10 +324,10 @@ def patients():
 @app.route('/patients/<path:patient_id>')
 def patient_dashboard(patient_id):
     if session.get('user'):
-        user_id = extract_user_id(session)
-        user_name = extract_user_name(session)
-        patient_key = Provider(user_id).get_patient_key(patient_id)
-        patient = Patient(patient_id, patient_key, encrypted=False)
+        user_id = extract_user_id()
+        user_name = extract_user_name()
+        patient = Patient(patient_id, None, encrypted=False)
+        patient.load_for_provider(user_id)
         patient_name = patient.get_first_name() + " " + patient.get_last_name()
         fsh_script, fsh_div = patient.get_chart('fsh')
         lh_script, lh_div = patient.get_chart('lh')
@@ -259,8 +338,8 @@ def patient_dashboard(patient_id):
         last_period = patient.get_last_period()
 
         return render_template('patient_dashboard.html', fsh_script=fsh_script, fsh_div=fsh_div,
-                               js_resources=INLINE.render_js(),
-                               css_resources=INLINE.render_css(), user_name=user_name, patient_name=patient_name,
+                               js_resources=JS_RESOURCES,
+                               css_resources=CSS_RESOURCES, user_name=user_name, patient_name=patient_name,
                                surveys=surveys, lh_div=lh_div, lh_script=lh_script, patient_id=patient_id,
                                lh_range=lh_range, fsh_range=fsh_range, last_period=last_period)
     else:
@@ -270,10 +349,11 @@ def patient_dashboard(patient_id):
 @app.route('/patients/<path:patient_id>/<path:date>')
 def patient_survey(patient_id, date):
     print(date)
-    user_id = extract_user_id(session)
-    user_name = extract_user_name(session)
-    patient_key = Provider(user_id).get_patient_key(patient_id)
-    survey = Patient(patient_id, patient_key, encrypted=False).get_survey_by_date(date)
+    user_id = extract_user_id()
+    user_name = extract_user_name()
+    patient = Patient(patient_id, None, encrypted=False)
+    patient.load_for_provider(user_id)
+    survey = patient.get_survey_by_date(date)
 
     return render_template('patient_survey.html', date=date, questions=survey, user_name=user_name)
 
@@ -310,17 +390,18 @@ def logout():
 @app.route("/add_patient", methods=['GET', 'POST'])
 def add_patient():
     if session.get('user'):
-        user_name = extract_user_name(session)
+        user_name = extract_user_name()
         if request.method == 'GET':
             return render_template('add_patient.html', user_name=user_name)
 
         elif request.method == 'POST':
-            user_id = extract_user_id(session)
+            user_id = extract_user_id()
             patient_id = request.form.get('patient_id')
             patient_key = request.form.get('patient_key')
 
             if Patient.verify_patient_credentials(patient_id, patient_key, encrypted=False):
                 provider = Provider(user_id)
+                provider.ensure_provisioned()
                 provider.add_patient(patient_id, patient_key)
 
                 return render_template('add_patient.html', user_name=user_name)
@@ -337,8 +418,8 @@ def add_patient():
 @app.route('/drop_patient')
 def drop_patient():
     if session.get('user'):
-        user_name = extract_user_name(session)
-        user_id = extract_user_id(session)
+        user_name = extract_user_name()
+        user_id = extract_user_id()
         provider = Provider(user_id=user_id)
 
         if not request.args.get('patient_id'):
@@ -1,11 +1,19 @@
 import os
 
 import pymongo
+from pymongo.errors import InvalidName
 import certifi
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from html import escape
+from markupsafe import Markup
 from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource
 from bokeh.embed import components
 from dotenv import find_dotenv, load_dotenv
+from flask_caching import Cache
 
 ENV_FILE = find_dotenv('.env')
 if ENV_FILE:
@@ -14,22 +22,122 @@ if ENV_FILE:
 db_conn = os.getenv('CONNECTION_STRING')
 date_format = '%m-%d-%Y'
 
+# Configured with a backend by the Flask app, see app.py
+cache = Cache()
+PATIENT_LIST_TTL = 60
+PATIENT_DETAILS_TTL = 300
+
+
+# The cache is only an optimisation, so backend errors fall back to Mongo
+def _cache_get(key):
+    try:
+        return cache.get(key)
+    except Exception as e:
+        print(f'Cache get failed: {str(e)}')
+        return None
+
+
+def _cache_get_many(*keys):
+    try:
+        return cache.get_many(*keys)
+    except Exception as e:
+        print(f'Cache get failed: {str(e)}')
+        return [None] * len(keys)
+
+
+def _cache_set(key, value, timeout):
+    try:
+        cache.set(key, value, timeout=timeout)
+    except Exception as e:
+        print(f'Cache set failed: {str(e)}')
+
+
+def _cache_set_many(mapping, timeout):
+    try:
+        cache.set_many(mapping, timeout=timeout)
+    except Exception as e:
+        print(f'Cache set failed: {str(e)}')
+
+
+def _cache_delete(key):
+    try:
+        cache.delete(key)
+    except Exception as e:
+        print(f'Cache delete failed: {str(e)}')
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(date):
+    return datetime.strptime(date, date_format)
+
+
+def _is_field_name(key):
+    # Mongo reads '.' and '$' in update and projection paths as path syntax
+    return '.' not in key and '$' not in key
+
+
+_CA = certifi.where()
+_CLIENT = pymongo.MongoClient(db_conn, tlsCAFile=_CA, maxPoolSize=50)
+# Shared pool for fanning out independent Mongo reads
+mongo_executor = ThreadPoolExecutor(max_workers=16)
+
 class Patient:
 
     def __init__(self, patient_id, patient_key, encrypted):
-        self.client = pymongo.MongoClient(db_conn, tlsCAFile=certifi.where())
+        self.client = _CLIENT
         self.patient_id = patient_id
-        self.patient_details = self.client['Patients'][patient_id].find_one({'entry_type': 'patient_details'})
         self.encrypted = encrypted
         self.patient_key = patient_key
+        self._loaded = False
+        self._details = None
+        self._fsh = None
+        self._lh = None
+        self._questions = list()
+        self._all_questions = None
+        self._metric_data = dict()
+
+    def _load_all(self):
+        if self._loaded:
+            return
+
+        entry_types = ['patient_details', 'fsh_values', 'lh_values', 'questions']
+        cursor = self.client['Patients'][self.patient_id].find({'entry_type': {'$in': entry_types}}, {'_id': 0})
+        for entry in cursor:
+            entry_type = entry['entry_type']
+            if entry_type == 'patient_details':
+                self._details = entry
+            elif entry_type == 'fsh_values':
+                self._fsh = entry['fsh_values']
+            elif entry_type == 'lh_values':
+                self._lh = entry['lh_values']
+            else:
+                self._questions.append(entry)
+
+        self._loaded = True
+
+    def load_for_provider(self, user_id):
+        # Overlaps the provider's ownership check with the entry load. The check raises KeyError for
+        # patients outside the provider's list, so details are only cached once it has passed.
+        key_lookup = mongo_executor.submit(Provider.get_patient_key, user_id, self.patient_id)
+        entries_load = mongo_executor.submit(self._load_all)
+        self.patient_key = key_lookup.result()
+        entries_load.result()
+        _cache_set(f'pd:{self.patient_id}', self._details, timeout=PATIENT_DETAILS_TTL)
+
+    @property
+    def patient_details(self):
+        self._load_all()
+        return self._details
 
     @staticmethod
     def verify_patient_credentials(patient_id, patient_key, encrypted=False):
         if not encrypted:
-            client = pymongo.MongoClient(db_conn, tlsCAFile=certifi.where())
-            if patient_id in client['Patients'].list_collection_names():
-                return True
-            else:
+            if not patient_id:
+                return False
+            details_filter = {'entry_type': 'patient_details'}
+            try:
+                return _CLIENT['Patients'][patient_id].find_one(details_filter, {'_id': 1}) is not None
+            except InvalidName:
                 return False
         else:
             pass  # TODO
@@ -39,43 +147,45 @@ class Patient:
             # TODO
             pass
         else:
-            return self.client['Patients'][self.patient_id].find_one({'entry_type': 'fsh_values'})['fsh_values']
+            self._load_all()
+            return self._fsh
 
     def _get_lh_data(self):
         if self.encrypted:
             # TODO
             pass
         else:
-            return self.client['Patients'][self.patient_id].find_one({'entry_type': 'lh_values'})['lh_values']
+            self._load_all()
+            return self._lh
+
+    def _metric_arrays(self, metric):
+        if metric not in self._metric_data:
+            data = (self._get_lh_data() if metric == 'lh' else self._get_fsh_data()) or dict()
+            dates = list(map(_parse_date, data.keys()))
+            vals = np.fromiter(map(float, data.values()), dtype=np.float64, count=len(data))
+            self._metric_data[metric] = (dates, vals)
+
+        return self._metric_data[metric]
 
     def get_range(self, metric='lh'):
-        data = self._get_lh_data() if metric == 'lh' else self._get_fsh_data()
-        if not data:
+        vals = self._metric_arrays(metric)[1]
+        if not len(vals):
             return ['n/a', 'n/a']
-        data = list(data.values())
-        data = [float(val) for val in data]
-        return [min(data), max(data)]
+        return [float(vals.min()), float(vals.max())]
 
     def get_chart(self, metric='lh'):
-        if metric == 'lh':
-            data = self._get_lh_data()
-        elif metric == 'fsh':
-            data = self._get_fsh_data()
-
         # TODO Handle no lh/fsh data
 
-        dates = [datetime.strptime(date, date_format) for date in data.keys()]
-        vals = list(data.values())
-        vals = [float(val) for val in vals]
+        dates, vals = self._metric_arrays(metric)
+
+        source = ColumnDataSource(data=dict(date=dates, val=vals))
 
-        chart = figure(height=350, x_axis_type='datetime', sizing_mode='stretch_width')
+        chart = figure(height=350, x_axis_type='datetime', sizing_mode='stretch_width', output_backend='webgl')
         chart.xaxis.axis_label = 'Date'
         chart.yaxis.axis_label = 'IU/L' if metric == 'lh' else 'mIU/ml'
-        chart.line(dates, vals, line_color='pink')
-        chart.varea(x=dates, y1=0, y2=vals, alpha=0.1, fill_color='LightPink')
-
-        for date, val in zip(dates, vals):
-            chart.scatter(date, val, color='HotPink', size=5)
+        chart.line(x='date', y='val', source=source, line_color='pink')
+        chart.varea(x='date', y1=0, y2='val', source=source, alpha=0.1, fill_color='LightPink')
+        chart.scatter(x='date', y='val', source=source, color='HotPink', size=5)
 
         chart.toolbar_location = None
 
@@ -104,40 +214,39 @@ class Patient:
 
     def _get_all_questions(self) -> dict:
         if not self.encrypted:
-            question_entries = self.client['Patients'][self.patient_id].find({'entry_type': 'questions'})
-            questions = dict()
-            for entry in question_entries:
-                date = entry['date']
-                questions[datetime.strptime(date, date_format)] = entry['questions']
+            if self._all_questions is None:
+                self._load_all()
+                questions = dict()
+                for entry in self._questions:
+                    date = entry['date']
+                    questions[_parse_date(date)] = entry['questions']
 
-            questions = dict(sorted(questions.items(), reverse=True))
+                self._all_questions = dict(sorted(questions.items(), reverse=True))
 
-            return questions
+            return self._all_questions
 
     def get_formatted_questions(self, date=None):
         questions = self._get_all_questions()
-        html_formatted = ""
+        parts = list()
 
-        for item in questions.items():
-            date = item[0].strftime(date_format)
-            questions = item[1]
-            formatted_string = f'<b>{date}</b><br>'
-            for question, answer in zip(questions.keys(), questions.values()):
-                formatted_string += f"{question}: <i>{answer}</i><br>"
-            html_formatted += formatted_string + "<br><br>"
+        for survey_date, survey_questions in questions.items():
+            parts.append(f'<b>{escape(survey_date.strftime(date_format))}</b><br>')
+            parts.extend(f'{escape(question)}: <i>{escape(str(answer))}</i><br>'
+                         for question, answer in survey_questions.items())
+            parts.append('<br><br>')
 
-        return html_formatted
+        return Markup(''.join(parts))
 
     def get_survey_by_date(self, date):
         questions = self._get_all_questions()
-        date = datetime.strptime(date, date_format)
+        date = _parse_date(date)
         questions = questions[date]
         return questions
 
     def get_surveys_overview(self):
         surveys = self._get_all_questions()
         surveys_overview = list()
-        for survey_key, survey_val in zip(surveys.keys(), surveys.values()):
+        for survey_key, survey_val in surveys.items():
             survey_dict = dict()
 
             survey_dict['date'] = survey_key.strftime(date_format)
@@ -158,22 +267,24 @@ class Patient:
 
     def get_last_period(self):
         surveys = self._get_all_questions()
-        period_dates = list()
 
-        for survey_key, survey_val in zip(surveys.keys(), surveys.values()):
-            if survey_val['On period?'] == 'Yes':
-                period_dates.append(survey_key)
+        # Surveys are sorted newest first, so the first match is the latest period
+        for survey_key, survey_val in surveys.items():
+            if survey_val.get('On period?') == 'Yes':
+                return survey_key.strftime(date_format)
 
-        return max(period_dates).strftime(date_format)
+        return 'n/a'
 
 
 
 
-    def _decrypt_string(self, data):
+    @staticmethod
+    def _decrypt_string(data):
         pass # TODO
         return False
 
-    def _decrypt_dict(self, data):
+    @staticmethod
+    def _decrypt_dict(data):
         pass # TODO
         return False
 
@@ -182,62 +293,105 @@ class Provider:
 
     def __init__(self, user_id):
         self.user_id = user_id
-        self.client = pymongo.MongoClient(db_conn, tlsCAFile=certifi.where())['Providers']
+        self.client = _CLIENT['Providers']
+        self._patient_list_cache = None
 
-        collections_list = self.client.list_collection_names()
-        patient_list_exists = self.client[self.user_id].find_one({'document_type': 'patient_list'}) is not None
-        if self.user_id not in collections_list:
-            self.client.create_collection(self.user_id)
-            self.client[self.user_id].insert_one({
-                'document_type': 'patient_list',
-                'patient_list': {}
-            })
+    def ensure_provisioned(self):
+        # Creates the collection and an empty patient_list on first use, in one round trip
+        self.client[self.user_id].update_one({'document_type': 'patient_list'},
+                                             {'$setOnInsert': {'patient_list': {}}}, upsert=True)
 
-        if not patient_list_exists:
-            self.client[self.user_id].insert_one({'document_type': 'patient_list', 'patient_list': {}})
+    @staticmethod
+    def get_patient_key(user_id, patient_id):
+        # Read from Mongo, never the cache, so a just-dropped patient can't pass the ownership check
+        if _is_field_name(patient_id):
+            projection = {f'patient_list.{patient_id}': 1}
+        else:
+            projection = {'patient_list': 1}
+        doc = _CLIENT['Providers'][user_id].find_one({'document_type': 'patient_list'}, projection)
+        patient_list = doc['patient_list'] if doc else dict()
+
+        return patient_list[patient_id]
 
     def get_patient_list(self):
+        if self._patient_list_cache is None:
+            cache_key = f'pl:{self.user_id}'
+            self._patient_list_cache = _cache_get(cache_key)
+            if self._patient_list_cache is None:
+                doc_filter = {'document_type': 'patient_list'}
+                doc = self.client[self.user_id].find_one(doc_filter)
+                self._patient_list_cache = doc['patient_list'] if doc else dict()
+                _cache_set(cache_key, self._patient_list_cache, timeout=PATIENT_LIST_TTL)
+
+        return self._patient_list_cache
+
+    # Write paths read and write Mongo directly, never the cached list, so a stale entry can't be written back
+    def _replace_patient_list(self, change):
         doc_filter = {'document_type': 'patient_list'}
-        doc = self.client[self.user_id].find_one(doc_filter)['patient_list']
+        patient_list = self.client[self.user_id].find_one(doc_filter)['patient_list']
+        change(patient_list)
+        self.client[self.user_id].replace_one(doc_filter, {
+            'document_type': 'patient_list',
+            'patient_list': patient_list
+        })
 
-        return doc
+    def _invalidate_patient_list(self):
+        self._patient_list_cache = None
+        _cache_delete(f'pl:{self.user_id}')
 
     def add_patient(self, patient_id, patient_key):
-        patient_list = self.get_patient_list()
+        if _is_field_name(patient_id):
+            self.client[self.user_id].update_one({'document_type': 'patient_list'},
+                                                 {'$set': {f'patient_list.{patient_id}': patient_key}})
+        else:
+            self._replace_patient_list(lambda patient_list: patient_list.update({patient_id: patient_key}))
 
-        patient_list[patient_id] = patient_key
-
-        self.client[self.user_id].replace_one({'document_type': 'patient_list'}, {
-            'document_type': 'patient_list',
-            'patient_list': patient_list
-        })
+        self._invalidate_patient_list()
 
     def drop_patient(self, patient_id):
-        patient_list = self.get_patient_list()
-        patient_list.pop(patient_id)
+        if _is_field_name(patient_id):
+            self.client[self.user_id].update_one({'document_type': 'patient_list'},
+                                                 {'$unset': {f'patient_list.{patient_id}': ''}})
+        else:
+            self._replace_patient_list(lambda patient_list: patient_list.pop(patient_id))
 
-        self.client[self.user_id].replace_one({'document_type': 'patient_list'}, {
-            'document_type': 'patient_list',
-            'patient_list': patient_list
-        })
+        self._invalidate_patient_list()
+
+    @staticmethod
+    def _bulk_patient_details(patient_ids):
+        def fetch(patient_id):
+            return _CLIENT['Patients'][patient_id].find_one({'entry_type': 'patient_details'}, {'_id': 0})
+
+        cached = _cache_get_many(*[f'pd:{patient_id}' for patient_id in patient_ids])
+        patient_details = dict(zip(patient_ids, cached))
+        missing = [patient_id for patient_id, details in patient_details.items() if details is None]
+
+        if missing:
+            fetched = dict(zip(missing, mongo_executor.map(fetch, missing)))
+            _cache_set_many({f'pd:{patient_id}': details for patient_id, details in fetched.items()},
+                           timeout=PATIENT_DETAILS_TTL)
+            patient_details.update(fetched)
+
+        return patient_details
 
     def patients_overview(self, encrypted=False):
-        patient_ids = list(self.get_patient_list().keys())
-        patient_keys = list(self.get_patient_list().values())
+        patient_list = self.get_patient_list()
         patients_overview = list()
 
-        if len(patient_ids) > 0:
-            for patient_id, patient_key in zip(patient_ids, patient_keys):
-                patient = Patient(patient_id=patient_id, patient_key=None, encrypted=encrypted)
+        if len(patient_list) > 0:
+            patient_details = self._bulk_patient_details(list(patient_list))
+            for patient_id in patient_list:
+                first_name = patient_details[patient_id]['first_name']
+                last_name = patient_details[patient_id]['last_name']
+                if encrypted:
+                    first_name = Patient._decrypt_string(first_name)
+                    last_name = Patient._decrypt_string(last_name)
                 patients_overview.append({
                     'patient_id': patient_id,
-                    'first_name': patient.get_first_name(),
-                    'last_name': patient.get_last_name()
+                    'first_name': first_name,
+                    'last_name': last_name
                   })
         else:
             patients_overview = list()
 
         return patients_overview
-
-    def get_patient_key(self, patient_id):
-        return self.get_patient_list()[patient_id]
\ No newline at end of file